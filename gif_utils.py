@@ -5,9 +5,15 @@
 
 from __future__ import annotations
 
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from typing import List, Tuple, Optional
 
+import numpy as np
 from PIL import Image
 
 
@@ -17,10 +23,14 @@ def _open_from_bytes(b: bytes) -> Image.Image:
 
 def _composite_on_bg(img: Image.Image, bg_rgb=(255, 255, 255)) -> Image.Image:
     """GIF 팔레트 변환 전, RGBA/투명은 배경 합성해서 안정화"""
+    if img.mode == "RGB":
+        return img  # ✅ 이미 RGB면 convert 복사 생략
     if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
-        rgba = img.convert("RGBA")
-        bg = Image.new("RGBA", rgba.size, (*bg_rgb, 255))
-        return Image.alpha_composite(bg, rgba).convert("RGB")
+        rgba = img if img.mode == "RGBA" else img.convert("RGBA")
+        # ✅ RGB 배경에 알파를 마스크로 바로 붙여넣기 → RGBA 배경/최종 convert 복사 없음 (결과는 alpha_composite와 동일)
+        bg = Image.new("RGB", rgba.size, bg_rgb)
+        bg.paste(rgba, mask=rgba)
+        return bg
     return img.convert("RGB")
 
 
@@ -31,7 +41,20 @@ def _resize_keep_aspect(img: Image.Image, max_width: Optional[int]) -> Image.Ima
     if w <= max_width:
         return img
     new_h = int(round(h * (max_width / w)))
-    return img.resize((max_width, new_h), Image.Resampling.LANCZOS)
+    # ✅ reducing_gap: 목표의 3배 크기까지는 정수배 박스 축소(빠름) → 마지막만 LANCZOS
+    # 크게 줄일 때(4000px → 450px 등) 2~3배 빠르고 화질 차이는 거의 없음
+    return img.resize((max_width, new_h), Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+
+def _pad_to(im: Image.Image, size: Tuple[int, int], bg_rgb=(255, 255, 255)) -> Image.Image:
+    """가운데 정렬로 size 캔버스에 패딩 (이미 같은 크기면 그대로)"""
+    if im.size == size:
+        return im
+    canvas = Image.new("RGB", size, bg_rgb)
+    x = (size[0] - im.size[0]) // 2
+    y = (size[1] - im.size[1]) // 2
+    canvas.paste(im, (x, y))
+    return canvas
 
 
 def _unify_canvas(frames: List[Image.Image], bg_rgb=(255, 255, 255)) -> List[Image.Image]:
@@ -40,17 +63,9 @@ def _unify_canvas(frames: List[Image.Image], bg_rgb=(255, 255, 255)) -> List[Ima
         return frames
     max_w = max(im.size[0] for im in frames)
     max_h = max(im.size[1] for im in frames)
-    out = []
-    for im in frames:
-        if im.size == (max_w, max_h):
-            out.append(im)
-            continue
-        canvas = Image.new("RGB", (max_w, max_h), bg_rgb)
-        x = (max_w - im.size[0]) // 2
-        y = (max_h - im.size[1]) // 2
-        canvas.paste(im, (x, y))
-        out.append(canvas)
-    return out
+    # ✅ 채우기/붙이기는 Pillow C 구간(GIL 해제) → 프레임별 병렬
+    # (NumPy 캔버스는 asarray/fromarray 복사가 2번 더 생겨서 오히려 느림)
+    return list(_POOL.map(lambda im: _pad_to(im, (max_w, max_h), bg_rgb), frames))
 
 
 def _dither_mode(dither: str):
@@ -62,6 +77,34 @@ def _dither_mode(dither: str):
     return Image.Dither.NONE
 
 
+def _bayer_matrix(n: int) -> np.ndarray:
+    """n x n Bayer 인덱스 행렬(0 ~ n*n-1), n은 2의 거듭제곱"""
+    m = np.zeros((1, 1), dtype=np.int32)
+    while m.shape[0] < n:
+        m = np.block([[4 * m, 4 * m + 2], [4 * m + 3, 4 * m + 1]])
+    return m
+
+
+# ✅ 8x8 Bayer 임계값(-0.5 ~ +0.5)은 고정 → 모듈 로드 때 1번만 계산
+_BAYER8 = ((_bayer_matrix(8) + 0.5) / 64.0 - 0.5).astype(np.float32)
+
+
+def _ordered_quantize(im: Image.Image, palette_seed: Image.Image, colors: int) -> Image.Image:
+    """
+    ✅ Bayer(ordered) 디더링
+    Pillow는 palette= 로 quantize할 때 ORDERED를 지원하지 않고 Floyd-Steinberg로 처리함
+    → 임계값 행렬을 NumPy로 더한 뒤 디더링 없이 팔레트 매핑
+    """
+    arr = np.asarray(im.convert("RGB"), dtype=np.int16)
+    h, w = arr.shape[:2]
+    # 팔레트가 촘촘할수록(색상수↑) 흔들림 폭을 줄임: 채널당 단계 ≈ colors^(1/3)
+    spread = 128.0 / max(2.0, colors ** (1.0 / 3.0))
+    thresh = np.rint(_BAYER8 * spread).astype(np.int16)
+    noise = np.tile(thresh, ((h + 7) // 8, (w + 7) // 8))[:h, :w, None]
+    dithered = np.clip(arr + noise, 0, 255).astype(np.uint8)
+    return Image.fromarray(dithered).quantize(palette=palette_seed, dither=Image.Dither.NONE)
+
+
 def _quantize_safe(im: Image.Image, colors: int) -> Image.Image:
     """
     ✅ 핵심:
@@ -92,14 +135,53 @@ def _quantize_safe(im: Image.Image, colors: int) -> Image.Image:
         raise RuntimeError(f"quantize failed. last={last_err!r}, final={e!r}") from e
 
 
+# ✅ 프레임 단위 작업(디코드/해시/quantize) 공용 스레드 풀
+# Pillow/hashlib은 C 구간에서 GIL을 풀어줌 → 코어 수만큼 병렬, 호출마다 스레드 새로 만들지 않음
+_POOL = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="gif_utils")
+
+
+# ✅ 팔레트 캐시: 같은 프레임/색상수면 재실행(딜레이·루프만 바꾼 경우 등)에서 quantize 생략
+# 값은 팔레트 리스트만 저장(이미지 X) → 메모리 부담 거의 없음
+_PALETTE_CACHE: "OrderedDict[bytes, List[int]]" = OrderedDict()
+_PALETTE_CACHE_MAX = 16
+_PALETTE_CACHE_LOCK = threading.Lock()
+
+
+def _frame_digest(im: Image.Image) -> bytes:
+    """프레임 픽셀 해시 (중복 프레임 판별용)"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{im.mode}{im.size}|".encode())
+    h.update(im.tobytes())
+    return h.digest()
+
+
+def _palette_cache_key(digests: List[bytes], colors: int, sample_pixels: int) -> bytes:
+    """샘플 프레임 해시(_frame_digest) 묶음 → 팔레트 캐시 키 (픽셀 재해싱 없음)"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{colors}/{sample_pixels}".encode())
+    for d in digests:
+        h.update(d)
+    return h.digest()
+
+
+def _palette_image(palette: List[int]) -> Image.Image:
+    """quantize(palette=...)에는 팔레트만 필요 → 1x1 P 이미지로 전달"""
+    seed = Image.new("P", (1, 1))
+    seed.putpalette(palette)
+    return seed
+
+
 def _build_palette_seed_from_frames(
     frames: List[Image.Image],
     colors: int,
     sample_count: int = 12,
+    sample_pixels: int = 200_000,
+    digests: Optional[List[bytes]] = None,
 ) -> Image.Image:
     """
     ✅ 팔레트를 여러 프레임 기반으로 만들기 (프레임마다 깨짐/깜빡임 감소)
     ✅ quantize ValueError 방지: _quantize_safe 사용
+    ✅ digests(프레임별 _frame_digest)를 넘기면 캐시 키 계산 때 픽셀을 다시 해싱하지 않음
     """
     if not frames:
         raise ValueError("frames empty")
@@ -113,14 +195,70 @@ def _build_palette_seed_from_frames(
         step = max(1, n // sample_count)
         picks = list(range(0, n, step))[:sample_count]
 
-    w, h = frames[0].size
-    stack = Image.new("RGB", (w, h * len(picks)))
-    for idx, fi in enumerate(picks):
-        stack.paste(frames[fi], (0, idx * h))
+    if digests is not None:
+        picked = [digests[fi] for fi in picks]
+    else:
+        picked = [_frame_digest(frames[fi]) for fi in picks]
+    key = _palette_cache_key(picked, colors, sample_pixels)
+    with _PALETTE_CACHE_LOCK:
+        cached = _PALETTE_CACHE.get(key)
+        if cached is not None:
+            _PALETTE_CACHE.move_to_end(key)
+            return _palette_image(cached)
+
+    # ✅ 프레임을 세로로 쌓지 않고, 프레임별 픽셀을 최대 N개씩 샘플링해서 1줄 이미지로
+    # 팔레트는 색 분포만 보면 되므로(위치 무관) 메모리/연산 대폭 감소
+    # 시드 고정 → 같은 입력이면 항상 같은 팔레트
+    rng = np.random.default_rng(0)
+    pools = []
+    for fi in picks:
+        im = frames[fi]
+        w, h = im.size
+        # ✅ 먼저 1/4 축소(NEAREST: 색을 섞지 않는 격자 샘플링) → 원래 색 그대로, 픽셀은 1/16만
+        if w >= 8 and h >= 8:
+            im = im.resize((w // 4, h // 4), Image.Resampling.NEAREST)
+        px = np.asarray(im).reshape(-1, 3)
+        if len(px) > sample_pixels:
+            px = px[rng.choice(len(px), sample_pixels, replace=False)]
+        pools.append(px)
+    sample = np.concatenate(pools).reshape(1, -1, 3)
 
     # ✅ 여기서 안전 quantize
-    palette_seed = _quantize_safe(stack, colors=colors)
-    return palette_seed
+    palette = _quantize_safe(Image.fromarray(sample), colors=colors).getpalette()
+
+    with _PALETTE_CACHE_LOCK:
+        _PALETTE_CACHE[key] = palette
+        while len(_PALETTE_CACHE) > _PALETTE_CACHE_MAX:
+            _PALETTE_CACHE.popitem(last=False)
+    return _palette_image(palette)
+
+
+def _load_frame(b: bytes, max_width: Optional[int]) -> Tuple[Image.Image, Optional[List[int]]]:
+    """
+    업로드 1장 -> 디코드 + 배경 합성 + 리사이즈 (스레드 풀에서 프레임별로 실행)
+    투명 없는 팔레트(P) 이미지면 원본 팔레트도 같이 반환 (아니면 None)
+    """
+    im = _open_from_bytes(b)
+    w, h = im.size
+    if max_width and w > max_width * 2:
+        # ✅ JPEG은 디코더에서 바로 축소(DCT 1/2~1/8) → 풀해상도 디코드 생략
+        # 목표 폭의 2배 이상은 남겨서 마지막 LANCZOS 품질 유지 (JPEG 외 포맷은 no-op)
+        im.draft(None, (max_width * 2, max(1, int(h * (max_width * 2) / w))))
+    im.load()
+    src_palette = im.getpalette() if im.mode == "P" and "transparency" not in im.info else None
+    im = _composite_on_bg(im, bg_rgb=(255, 255, 255))
+    return _resize_keep_aspect(im, max_width=max_width), src_palette
+
+
+def make_thumbnail(b: bytes, width: int) -> bytes:
+    """미리보기용 작은 JPEG (원본 해상도 그대로 st.image에 넘기지 않기)"""
+    im = _open_from_bytes(b)
+    # 썸네일은 BILINEAR로 충분 (LANCZOS 대비 훨씬 빠름)
+    im.thumbnail((width, width * 4), Image.Resampling.BILINEAR)
+    im = _composite_on_bg(im, bg_rgb=(255, 255, 255))
+    buf = BytesIO()
+    im.save(buf, format="JPEG", quality=75)
+    return buf.getvalue()
 
 
 def build_gif_from_images(
@@ -135,39 +273,76 @@ def build_gif_from_images(
     if not files:
         return None
 
-    frames: List[Image.Image] = []
-    for _, b in files:
-        im = _open_from_bytes(b)
-        im.load()
-        im = _composite_on_bg(im, bg_rgb=(255, 255, 255))
-        im = _resize_keep_aspect(im, max_width=max_width)
-        frames.append(im)
+    # ✅ 프레임 준비(디코드/리사이즈)는 Pillow가 GIL을 풀어주므로 코어 수만큼 병렬 처리
+    loaded = list(_POOL.map(lambda b: _load_frame(b, max_width), (b for _, b in files)))
+    frames: List[Image.Image] = [im for im, _ in loaded]
 
     if not frames:
         return None
 
+    # ✅ 이미 같은 팔레트로 만든 GIF/PNG 프레임 묶음이면 그 팔레트를 그대로 사용 (샘플링+quantize 생략)
+    # 색상수 설정 이하 & 크기가 모두 같을 때만 (패딩 배경색이 팔레트에 없을 수 있으므로)
+    src_palettes = [pal for _, pal in loaded]
+    shared_palette = src_palettes[0]
+    if (
+        shared_palette is None
+        or len(shared_palette) // 3 > int(colors)
+        or any(pal != shared_palette for pal in src_palettes[1:])
+        or len({im.size for im in frames}) > 1
+    ):
+        shared_palette = None
+
     if unify_canvas:
         frames = _unify_canvas(frames, bg_rgb=(255, 255, 255))
 
+    # ✅ 연속으로 똑같은 프레임은 1장으로 합치고 delay만 늘리기 (quantize/용량 절감)
+    digests = list(_POOL.map(_frame_digest, frames))
+    runs: List[Tuple[Image.Image, bytes, int]] = []
+    for im, d in zip(frames, digests):
+        if runs and runs[-1][1] == d:
+            runs[-1] = (runs[-1][0], d, runs[-1][2] + 1)
+        else:
+            runs.append((im, d, 1))
+    frames = [im for im, _, _ in runs]
+
     colors = int(colors)
-    palette_seed = _build_palette_seed_from_frames(frames, colors=colors, sample_count=12)
+    if shared_palette is not None:
+        palette_seed = _palette_image(shared_palette)
+    else:
+        palette_seed = _build_palette_seed_from_frames(
+            frames, colors=colors, sample_count=12, digests=[d for _, d, _ in runs]
+        )
 
     dither_mode = _dither_mode(dither)
-    pal_frames: List[Image.Image] = []
-    for im in frames:
-        q = im.quantize(palette=palette_seed, dither=dither_mode)
-        pal_frames.append(q)
+    if dither_mode == Image.Dither.ORDERED:
+        quantize = lambda im: _ordered_quantize(im, palette_seed, colors)
+    else:
+        quantize = lambda im: im.quantize(palette=palette_seed, dither=dither_mode)
+    # ✅ 프레임별 quantize도 GIL 해제 구간 → 병렬 (palette_seed는 읽기 전용 공유)
+    # 떨어져 있는 중복 프레임도 quantize는 1번만 (해시 기준 재사용)
+    uniq = {}
+    for im, d, _ in runs:
+        uniq.setdefault(d, im)
+    quantized = dict(zip(uniq.keys(), _POOL.map(quantize, uniq.values())))
+    pal_frames: List[Image.Image] = [quantized[d] for _, d, _ in runs]
 
     duration_ms = int(round(float(delay_sec) * 1000))
+    durations = [duration_ms * n for _, _, n in runs]
     out = BytesIO()
 
+    # loop=0: 무한 반복 / loop 생략: 1회 재생 (loop=1은 "1번 더" = 2회 재생)
+    loop_kw = {"loop": 0} if loop_forever else {}
+    if not loop_forever:
+        # ✅ GIF 업로드의 loop 값이 convert/resize/quantize를 거쳐 info에 남아 있으면 Pillow가 그대로 씀 → 제거
+        pal_frames[0].info.pop("loop", None)
+
     pal_frames[0].save(
         out,
         format="GIF",
         save_all=True,
         append_images=pal_frames[1:],
-        duration=duration_ms,
-        loop=0 if loop_forever else 1,
+        duration=durations,
+        **loop_kw,
         optimize=False,
         disposal=2,
     )
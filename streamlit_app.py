@@ -1,9 +1,82 @@
+import hashlib
+import time
+
 import streamlit as st
-from gif_utils import build_gif_from_images
-from video_utils import build_gif_from_video_ffmpeg
+from gif_utils import build_gif_from_images, make_thumbnail
+from video_utils import build_gif_from_video_ffmpeg, staged_video
 
 st.set_page_config(page_title="미샵 GIF 생성기", layout="wide")
 
+
+THUMB_W = 140  # 썸네일 가로폭
+
+
+def _make_thumb(b: bytes) -> bytes | None:
+    """✅ 업로드 시 1번만 썸네일 생성 → 순서 이동/삭제 rerun 때 원본 디코드/해시 없음"""
+    try:
+        return make_thumbnail(b, THUMB_W)
+    except Exception:
+        return None
+
+
+def _digest(b: bytes) -> str:
+    return hashlib.blake2b(b, digest_size=16).hexdigest()
+
+
+# ✅ 같은 이미지/순서/옵션으로 다시 누르면 결과 재사용 (딜레이만 바꿔 다시 만들기 등)
+# 캐시 키는 업로드 때 계산해 둔 해시 목록(content_key), 원본 bytes(_files)는 해싱 제외
+@st.cache_data(max_entries=4, show_spinner=False)
+def _make_gif(
+    content_key: tuple,
+    _files: list,
+    delay_sec: float,
+    loop_forever: bool,
+    unify_canvas: bool,
+    max_width: int | None,
+    colors: int,
+    dither: str,
+) -> bytes | None:
+    return build_gif_from_images(
+        files=_files,
+        delay_sec=delay_sec,
+        loop_forever=loop_forever,
+        unify_canvas=unify_canvas,
+        max_width=max_width,
+        colors=colors,
+        dither=dither,
+    )
+
+
+# ✅ 순서 조작은 on_click 콜백으로: 스크립트 실행 전에 상태가 바뀌므로 st.rerun() 2번 실행 불필요
+def _pick(i: int):
+    st.session_state.selected_idx = i
+
+
+def _move_selected(delta: int):
+    order = st.session_state.img_order
+    i = st.session_state.selected_idx
+    order[i], order[i + delta] = order[i + delta], order[i]
+    st.session_state.selected_idx = i + delta
+
+
+def _delete_selected():
+    order = st.session_state.img_order
+    i = st.session_state.selected_idx
+    order.pop(i)
+    st.session_state.selected_idx = max(0, min(i, len(order) - 1))
+
+
+def _clear_items():
+    st.session_state.uploaded_items = ()
+    st.session_state.img_order = []
+    st.session_state.img_upload_token = None
+    st.session_state.selected_idx = 0
+
+
+def _cancel_video():
+    st.session_state.vid_cancelled = True
+
+
 # ===============================
 # ✅ Footer / Copyright (항상 보이게)
 # ===============================
@@ -41,7 +114,8 @@ tab_img, tab_vid = st.tabs(["이미지 → GIF", "동영상 → GIF"])
 # ✅ session_state 기본값
 # ===============================
 defaults = {
-    "uploaded_items": [],      # [{"name":..., "bytes":...}, ...]
+    "uploaded_items": (),      # ({"name":..., "bytes":..., "thumb":..., "digest":...}, ...) 업로드 시 1번만 저장(불변)
+    "img_order": [],           # ✅ 현재 순서 = uploaded_items 인덱스 목록 (이동/삭제는 여기만 수정)
     "img_upload_token": None,  # 업로드가 '진짜 바뀐 경우'만 갱신
     "selected_idx": 0,         # ✅ 썸네일 선택 인덱스
 
@@ -50,6 +124,8 @@ defaults = {
     "vid_colors": 64,
     "vid_dither": "none",
     "vid_loop": True,
+    "vid_decimate": False,
+    "vid_cancelled": False,
     "vid_clip_on": True,
     "vid_clip_start": 0.0,
     "vid_clip_end": 3.0,
@@ -112,6 +188,7 @@ with st.sidebar:
     st.selectbox("색상수(팔레트)", [64, 96, 128, 256], key="vid_colors")
     st.selectbox("디더링", ["none", "floyd"], key="vid_dither")
     st.checkbox("무한 루프(Forever)", key="vid_loop")
+    st.checkbox("중복 프레임 제거", key="vid_decimate", help="화면 녹화처럼 멈춘 구간이 많으면 용량/변환 시간이 크게 줄어듭니다. (마지막 정지 구간은 최대 약 1초 짧아질 수 있음)")
 
     st.divider()
     st.checkbox("구간 자르기(추천)", key="vid_clip_on")
@@ -141,41 +218,49 @@ with tab_img:
         token = tuple((f.name, getattr(f, "size", None)) for f in files)
         if st.session_state.img_upload_token != token:
             st.session_state.img_upload_token = token
-            st.session_state.uploaded_items = [{"name": f.name, "bytes": f.getvalue()} for f in files]
+            st.session_state.uploaded_items = tuple(
+                {
+                    "name": f.name,
+                    "bytes": f.getvalue(),
+                    "thumb": _make_thumb(f.getvalue()),
+                    "digest": _digest(f.getvalue()),
+                }
+                for f in files
+            )
+            st.session_state.img_order = list(range(len(files)))
             st.session_state.selected_idx = 0
 
-    if not st.session_state.uploaded_items:
+    if not st.session_state.img_order:
         st.info("이미지를 업로드해 주세요.")
     else:
-        items = list(st.session_state.uploaded_items)
+        items = st.session_state.uploaded_items
+        order = st.session_state.img_order
 
         # selected_idx 안전 처리
         if st.session_state.selected_idx < 0:
             st.session_state.selected_idx = 0
-        if st.session_state.selected_idx >= len(items):
-            st.session_state.selected_idx = max(0, len(items) - 1)
+        if st.session_state.selected_idx >= len(order):
+            st.session_state.selected_idx = max(0, len(order) - 1)
 
         st.markdown("### 업로드된 이미지 순서 (썸네일 6개씩)")
         cols_per_row = 6
-        thumb_w = 140
 
         # --- 썸네일 그리드 ---
-        for row_start in range(0, len(items), cols_per_row):
+        for row_start in range(0, len(order), cols_per_row):
             cols = st.columns(cols_per_row, gap="small")
             for j, col in enumerate(cols):
                 i = row_start + j
-                if i >= len(items):
+                if i >= len(order):
                     break
                 with col:
-                    try:
-                        st.image(items[i]["bytes"], width=thumb_w)
-                    except Exception:
+                    thumb = items[order[i]]["thumb"]
+                    if thumb:
+                        st.image(thumb, width=THUMB_W)
+                    else:
                         st.write("미리보기 불가")
 
                     label = "✅" if i == st.session_state.selected_idx else "선택"
-                    if st.button(label, key=f"pick_{i}", use_container_width=True):
-                        st.session_state.selected_idx = i
-                        st.rerun()
+                    st.button(label, key=f"pick_{i}", use_container_width=True, on_click=_pick, args=(i,))
 
         st.divider()
 
@@ -184,45 +269,32 @@ with tab_img:
 
         c1, c2, c3, c4, c5 = st.columns([4, 2, 2, 2, 6])
         with c1:
-            st.write(f"선택: **{i+1}. {items[i]['name']}**")
+            st.write(f"선택: **{i+1}. {items[order[i]]['name']}**")
 
         with c2:
-            if st.button("⬆ 위로", disabled=(i == 0), use_container_width=True, key="sel_up"):
-                items[i - 1], items[i] = items[i], items[i - 1]
-                st.session_state.uploaded_items = items
-                st.session_state.selected_idx = i - 1
-                st.rerun()
+            st.button("⬆ 위로", disabled=(i == 0), use_container_width=True, key="sel_up",
+                      on_click=_move_selected, args=(-1,))
 
         with c3:
-            if st.button("⬇ 아래로", disabled=(i == len(items) - 1), use_container_width=True, key="sel_down"):
-                items[i + 1], items[i] = items[i], items[i + 1]
-                st.session_state.uploaded_items = items
-                st.session_state.selected_idx = i + 1
-                st.rerun()
+            st.button("⬇ 아래로", disabled=(i == len(order) - 1), use_container_width=True, key="sel_down",
+                      on_click=_move_selected, args=(1,))
 
         with c4:
-            if st.button("🗑 삭제", use_container_width=True, key="sel_del"):
-                items.pop(i)
-                st.session_state.uploaded_items = items
-                st.session_state.selected_idx = max(0, min(i, len(items) - 1))
-                st.rerun()
+            st.button("🗑 삭제", use_container_width=True, key="sel_del", on_click=_delete_selected)
 
         with c5:
-            if st.button("🧹 목록 초기화", key="img_clear", use_container_width=True):
-                st.session_state.uploaded_items = []
-                st.session_state.img_upload_token = None
-                st.session_state.selected_idx = 0
-                st.rerun()
+            st.button("🧹 목록 초기화", key="img_clear", use_container_width=True, on_click=_clear_items)
 
         st.caption("정렬 후 **GIF 만들기**를 누르면, 현재 순서대로 GIF가 생성됩니다.")
         st.divider()
 
         if st.button("GIF 만들기", type="primary", key="img_make"):
-            ordered_pairs = [(x["name"], x["bytes"]) for x in st.session_state.uploaded_items]
+            ordered_pairs = [(items[k]["name"], items[k]["bytes"]) for k in order]
 
             with st.spinner("포토샵급 고화질 GIF 생성 중..."):
-                gif_bytes = build_gif_from_images(
-                    files=ordered_pairs,
+                gif_bytes = _make_gif(
+                    tuple(items[k]["digest"] for k in order),
+                    ordered_pairs,
                     delay_sec=float(delay),
                     loop_forever=bool(loop_forever_img),
                     unify_canvas=bool(unify_canvas),
@@ -261,23 +333,54 @@ with tab_vid:
         key="vid_uploader",
     )
 
+    if st.session_state.vid_cancelled:
+        st.session_state.vid_cancelled = False
+        st.info("변환을 취소했습니다.")
+
     if st.button("동영상 GIF 만들기", type="primary", disabled=not vfile, key="vid_make"):
         if st.session_state.vid_clip_on and st.session_state.vid_clip_end <= st.session_state.vid_clip_start:
             st.error("구간 설정이 잘못되었습니다. (종료 > 시작)")
         else:
             max_width_vid_val = None if st.session_state.vid_width == "원본 유지" else int(st.session_state.vid_width)
 
-            with st.spinner("동영상 → GIF 변환 중(팔레트 최적화 + 용량 절감)..."):
+            clip_len = (
+                float(st.session_state.vid_clip_end) - float(st.session_state.vid_clip_start)
+                if st.session_state.vid_clip_on
+                else None
+            )
+            # ✅ 진행률 + 취소: 취소 버튼 클릭 → 재실행 → 다음 progress 갱신(0.5초마다)에서 스크립트가 중단되며 ffmpeg 종료
+            bar = st.progress(0.0, text="동영상 → GIF 변환 중(팔레트 최적화 + 용량 절감)...")
+            cancel_slot = st.empty()
+            cancel_slot.button("⏹ 취소", key="vid_cancel", on_click=_cancel_video)
+            t0 = time.monotonic()
+
+            def _on_progress(sec: float):
+                elapsed = time.monotonic() - t0
+                if sec <= 0:
+                    bar.progress(0.0, text=f"프레임 분석/팔레트 생성 중... ({elapsed:.0f}초 경과)")
+                elif clip_len:
+                    bar.progress(min(sec / clip_len, 1.0), text=f"GIF 인코딩 중... {sec:.1f}/{clip_len:.1f}초 ({elapsed:.0f}초 경과)")
+                else:
+                    bar.progress(0.5, text=f"GIF 인코딩 중... {sec:.1f}초 처리 ({elapsed:.0f}초 경과)")
+
+            start_sec = float(st.session_state.vid_clip_start) if st.session_state.vid_clip_on else None
+            end_sec = float(st.session_state.vid_clip_end) if st.session_state.vid_clip_on else None
+
+            with staged_video(vfile, start_sec=start_sec) as video:
                 gif_bytes = build_gif_from_video_ffmpeg(
-                    video_bytes=vfile.getvalue(),
+                    video=video,
                     fps=int(st.session_state.vid_fps),
                     max_width=max_width_vid_val,
                     loop_forever=bool(st.session_state.vid_loop),
-                    start_sec=float(st.session_state.vid_clip_start) if st.session_state.vid_clip_on else None,
-                    end_sec=float(st.session_state.vid_clip_end) if st.session_state.vid_clip_on else None,
+                    start_sec=start_sec,
+                    end_sec=end_sec,
                     colors=int(st.session_state.vid_colors),
                     dither=str(st.session_state.vid_dither),
+                    decimate=bool(st.session_state.vid_decimate),
+                    on_progress=_on_progress,
                 )
+            bar.empty()
+            cancel_slot.empty()  # 끝난 뒤 취소를 누르면 결과가 사라지므로 버튼도 제거
 
             size_mb = len(gif_bytes) / (1024 * 1024)
             st.success(f"완료! (약 {size_mb:.1f} MB)")
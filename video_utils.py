@@ -1,14 +1,179 @@
 from __future__ import annotations
 import os
+import queue
+import re
+import shutil
 import tempfile
+import threading
 import subprocess
-from typing import Optional
+from contextlib import contextmanager
+from typing import BinaryIO, Callable, Iterator, List, Optional, Union
 
 import imageio_ffmpeg
 
+# ✅ ffmpeg 멀티코어: 디코더 + 필터(scale/palette) 스레드 모두 0 = ffmpeg가 코어 수 자동 감지
+FFMPEG_THREAD_ARGS = [
+    "-threads", "0",
+    "-filter_threads", "0",
+    "-filter_complex_threads", "0",
+]
+
+
+def _fast_tmp(size: Optional[int] = None) -> str:
+    """
+    임시 파일 위치: /dev/shm(RAM)에 size의 2배 이상 여유가 있으면 우선, 아니면 기본 temp
+    (Docker 기본 /dev/shm은 64MB → 큰 업로드는 디스크로, 크기를 모르면 디스크)
+    """
+    if size is None or not (os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK)):
+        return tempfile.gettempdir()
+    try:
+        if shutil.disk_usage("/dev/shm").free >= size * 2:
+            return "/dev/shm"
+    except OSError:
+        pass
+    return tempfile.gettempdir()
+
+
+# -progress 출력 한 줄 (key=value)
+_PROGRESS_LINE = re.compile(rb"^([a-z0-9_]+)=(.*)$")
+
+
+def _run_ffmpeg(
+    cmd: List[str],
+    input_bytes: Optional[bytes] = None,
+    on_progress: Optional[Callable[[float], None]] = None,
+) -> bytes:
+    """
+    ffmpeg 실행(input_bytes는 stdin으로) → stdout(GIF bytes) 반환. 실패하면 stderr 담아서 CalledProcessError
+    on_progress가 있으면 cmd에 "-progress pipe:2"가 들어있어야 함 → 진행 블록마다 + 0.5초마다 출력 시각(초)으로 콜백
+    """
+    # ✅ 큰 버퍼로 stdout 읽기(시스템콜 감소), stdin/stdout/stderr는 동시에 처리 → 파이프 막힘 없음
+    stdin = subprocess.PIPE if input_bytes is not None else subprocess.DEVNULL
+    with subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1 << 20) as p:
+        if on_progress is None:
+            out, err = p.communicate(input_bytes)
+        else:
+            out, err = _communicate_with_progress(p, input_bytes, on_progress)
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd, output=out, stderr=err)
+    return out
+
+
+def _communicate_with_progress(
+    p: subprocess.Popen,
+    input_bytes: Optional[bytes],
+    on_progress: Callable[[float], None],
+):
+    """
+    stdin 쓰기/stdout 읽기/stderr(-progress) 읽기는 스레드, 호출 스레드는 0.5초마다 콜백
+    ffmpeg는 palettegen이 입력을 다 읽을 때까지 progress 블록을 안 씀 → 출력과 상관없이 주기적으로 호출
+    """
+    chunks: List[bytes] = []
+    lines: "queue.Queue[Optional[bytes]]" = queue.Queue()
+
+    def _pump_out():
+        chunks.append(p.stdout.read())
+
+    def _pump_err():
+        for line in p.stderr:
+            lines.put(line)
+        lines.put(None)  # EOF
+
+    def _pump_in():
+        try:
+            p.stdin.write(input_bytes)
+        except BrokenPipeError:
+            pass  # trim 등으로 ffmpeg가 먼저 입력을 닫은 경우
+        finally:
+            p.stdin.close()
+
+    threads = [
+        threading.Thread(target=_pump_out, daemon=True),
+        threading.Thread(target=_pump_err, daemon=True),
+    ]
+    if input_bytes is not None:
+        threads.append(threading.Thread(target=_pump_in, daemon=True))
+    for t in threads:
+        t.start()
+
+    err_lines: List[bytes] = []
+    out_time = 0.0
+    try:
+        while True:
+            try:
+                line = lines.get(timeout=0.5)
+            except queue.Empty:
+                # ✅ 0.5초마다 heartbeat → 팔레트 생성 중에도 경과 시간 갱신/취소 확인 가능
+                on_progress(out_time)
+                continue
+            if line is None:
+                break
+            m = _PROGRESS_LINE.match(line.strip())
+            if not m:
+                err_lines.append(line)
+            elif m.group(1) == b"out_time_us" and m.group(2).isdigit():
+                out_time = int(m.group(2)) / 1_000_000
+            elif m.group(1) == b"progress":
+                on_progress(out_time)
+        p.wait()
+    except BaseException:
+        # ✅ 콜백에서 예외(Streamlit 취소/재실행 등) → ffmpeg 즉시 종료
+        p.kill()
+        raise
+    for t in threads:
+        t.join()
+    return b"".join(chunks), b"".join(err_lines)
+
+
+def _pipe_friendly(data: bytes) -> bool:
+    """
+    탐색(seek) 없이 stdin으로 읽어도 되는 컨테이너인지
+    - WebM/MKV: 스트리밍용 → OK
+    - MP4/MOV: moov(인덱스)가 mdat(데이터)보다 앞(faststart)일 때만 OK
+    """
+    if data[:4] == b"\x1a\x45\xdf\xa3":  # EBML (WebM/MKV)
+        return True
+    pos, n = 0, len(data)
+    while pos + 8 <= n:
+        size = int.from_bytes(data[pos:pos + 4], "big")
+        box = data[pos + 4:pos + 8]
+        if box == b"moov":
+            return True
+        if box == b"mdat":
+            return False
+        if size == 1 and pos + 16 <= n:  # 64bit 크기
+            size = int.from_bytes(data[pos + 8:pos + 16], "big")
+        if size < 8:
+            return False
+        pos += size
+    return False
+
+
+@contextmanager
+def staged_video(fileobj: BinaryIO, start_sec: Optional[float] = None) -> Iterator[Union[str, bytes]]:
+    """
+    업로드 파일 → ffmpeg 입력 준비
+    - getvalue()로 컨테이너 판별 (UploadedFile은 BytesIO → 내부 버퍼를 그대로 돌려줌, 복사 X)
+    - stdin으로 흘려도 되는 컨테이너(WebM, faststart MP4/MOV)이고 처음부터 자르면 그 bytes 그대로 (임시 파일 X)
+    - 아니면 임시 경로로 1MB씩 복사, with 끝나면 삭제
+      (start_sec > 0이면 stdin은 탐색이 안 돼 앞부분을 전부 디코드 → 파일로 두고 -ss로 바로 탐색하는 게 훨씬 빠름)
+    """
+    data = fileobj.getvalue() if hasattr(fileobj, "getvalue") else None
+    if data is not None and not (start_sec and start_sec > 0) and _pipe_friendly(data):
+        yield data
+        return
+
+    ext = os.path.splitext(getattr(fileobj, "name", "") or "")[1] or ".mp4"
+    with tempfile.TemporaryDirectory(dir=_fast_tmp(getattr(fileobj, "size", None))) as td:
+        path = os.path.join(td, "input_video" + ext)
+        fileobj.seek(0)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(fileobj, f, 1 << 20)
+        yield path
+
 
 def build_gif_from_video_ffmpeg(
-    video_bytes: bytes,
+    video: Union[str, bytes],
     fps: int = 12,
     max_width: Optional[int] = 720,
     loop_forever: bool = True,
@@ -16,76 +181,82 @@ def build_gif_from_video_ffmpeg(
     end_sec: Optional[float] = None,
     colors: int = 128,
     dither: str = "floyd",  # "floyd" or "none"
+    decimate: bool = False,
+    on_progress: Optional[Callable[[float], None]] = None,
 ) -> bytes:
     """
     동영상 -> GIF (고퀄/저용량)
-    핵심: palettegen + paletteuse, 그리고 팔레트 색상수 제한(colors), fps, width 조절
+    핵심: palettegen + paletteuse (ffmpeg 1회 실행), 그리고 팔레트 색상수 제한(colors), fps, width 조절
 
+    - video: 입력 동영상 경로, 또는 stdin으로 넘길 bytes (업로드는 staged_video로 준비)
     - fps: 낮출수록 용량 대폭 감소 (권장 8~15)
     - max_width: 가로폭 낮출수록 용량 대폭 감소 (권장 540~720)
     - colors: 64/96/128/256 (낮출수록 용량 감소, 96~128이 실무 밸런스)
     - dither: floyd가 품질 좋지만 약간 용량↑, none은 더 가벼움
+    - decimate: 중복(정지) 프레임 제거 (화면 녹화/정지 구간 많을 때 용량·시간 대폭 감소)
+    - on_progress: 진행 콜백(출력된 GIF 시각, 초). 콜백에서 예외가 나면 ffmpeg 중단
+      (약 0.5초마다 호출, 팔레트를 먼저 만들어야 해서 입력을 다 읽기 전까지는 0에 머무름)
     """
 
     ffmpeg = imageio_ffmpeg.get_ffmpeg_exe()
+    piped = isinstance(video, bytes)
 
-    with tempfile.TemporaryDirectory() as td:
-        in_path = os.path.join(td, "input_video.mp4")
-        pal_path = os.path.join(td, "palette.png")
-        out_path = os.path.join(td, "output.gif")
+    # ✅ 구간: filter_complex에서는 -ss/-t가 정확히 적용되지 않음
+    # (파일: 키프레임까지만 탐색 → 앞 구간이 섞임 / stdin: -ss 무시) → 그래프 안에서 trim으로 자름
+    trim = []
+    if start_sec is not None and start_sec > 0:
+        trim.append(f"start={start_sec}")
+    if end_sec is not None and end_sec > (start_sec or 0):
+        trim.append(f"end={end_sec}")
+    trim_filter = f"trim={':'.join(trim)},setpts=PTS-STARTPTS," if trim else ""
 
-        with open(in_path, "wb") as f:
-            f.write(video_bytes)
+    # 파일 입력은 시작 지점 근처 키프레임으로 빠르게 탐색만 (-copyts -start_at_zero: 타임스탬프를 원본 기준으로 유지 → trim 정확)
+    # stdin 입력은 탐색 불가 → 처음부터 디코드하고 trim이 버림
+    seek = []
+    if not piped and start_sec is not None and start_sec > 0:
+        seek = ["-ss", str(start_sec), "-copyts", "-start_at_zero"]
 
-        # 구간 옵션
-        ss = []
-        if start_sec is not None and start_sec >= 0:
-            ss = ["-ss", str(start_sec)]
+    # 스케일 필터
+    if max_width:
+        scale_filter = f"scale={max_width}:-1:flags=lanczos"
+    else:
+        scale_filter = "scale=iw:ih:flags=lanczos"
 
-        dur = []
-        if end_sec is not None and start_sec is not None and end_sec > start_sec:
-            dur = ["-t", str(end_sec - start_sec)]
-        elif end_sec is not None and start_sec is None and end_sec > 0:
-            dur = ["-to", str(end_sec)]
+    # ✅ 중복 프레임 제거: fps 뒤에 둬야 fps 필터가 빈 자리를 다시 채우지 않음
+    # 제거된 프레임 시간은 앞 프레임 delay로 흡수 (-fps_mode passthrough)
+    # max={fps}: 연속 제거는 최대 fps장(약 1초)까지 → 마지막 정지 구간이 1프레임으로 줄어들지 않음 (최대 약 1초만 짧아짐)
+    if decimate:
+        base_filter = f"{trim_filter}fps={fps},mpdecimate=max={fps},{scale_filter}"
+        vsync = ["-fps_mode", "passthrough"]
+    else:
+        base_filter = f"{trim_filter}fps={fps},{scale_filter}"
+        vsync = []
 
-        # 스케일 필터
-        if max_width:
-            scale_filter = f"scale={max_width}:-1:flags=lanczos"
-        else:
-            scale_filter = "scale=iw:ih:flags=lanczos"
-
-        # 디더
-        dither_mode = "floyd_steinberg" if dither == "floyd" else "none"
-
-        # ✅ palettegen: max_colors로 색상 제한 (용량 절감 핵심)
-        # stats_mode=full: 안정적인 팔레트
-        cmd_palette = [
-            ffmpeg,
-            *ss,
-            "-i", in_path,
-            *dur,
-            "-vf", f"fps={fps},{scale_filter},palettegen=stats_mode=full:max_colors={colors}",
-            "-y",
-            pal_path
-        ]
-
-        # ✅ paletteuse: 디더링 적용 + 알파 처리 향상
-        loop_flag = 0 if loop_forever else 1
-        cmd_gif = [
-            ffmpeg,
-            *ss,
-            "-i", in_path,
-            *dur,
-            "-i", pal_path,
-            "-lavfi",
-            f"fps={fps},{scale_filter}[x];[x][1:v]paletteuse=dither={dither_mode}:diff_mode=rectangle",
-            "-loop", str(loop_flag),
-            "-y",
-            out_path
-        ]
-
-        subprocess.run(cmd_palette, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        subprocess.run(cmd_gif, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        with open(out_path, "rb") as f:
-            return f.read()
+    # 디더
+    dither_mode = "floyd_steinberg" if dither == "floyd" else "none"
+
+    # ✅ 1회 실행: split으로 스트림을 나눠 palettegen → paletteuse (디코드/스케일 1번만)
+    # palettegen: max_colors로 색상 제한 (용량 절감 핵심), stats_mode=full: 구간 전체 색 분포 (diff는 장면이 바뀐 뒤 색을 빠뜨림)
+    # paletteuse: 디더링 적용 + 변경 영역만 갱신(diff_mode=rectangle)
+    # -loop 0: 무한 반복 / -1: 1회 재생 (1은 "1번 더" = 2회 재생)
+    loop_flag = 0 if loop_forever else -1
+    cmd_gif = [
+        ffmpeg,
+        # ✅ 진행 로그 끄기(에러만) → stderr 파이프 부담 감소
+        "-hide_banner", "-loglevel", "error", "-nostats",
+        *(["-progress", "pipe:2"] if on_progress else []),
+        *FFMPEG_THREAD_ARGS,
+        *seek,
+        "-i", "pipe:0" if piped else video,
+        "-filter_complex",
+        f"[0:v]{base_filter},split[a][b];"
+        f"[a]palettegen=stats_mode=full:max_colors={colors}[p];"
+        f"[b][p]paletteuse=dither={dither_mode}:diff_mode=rectangle",
+        *vsync,
+        "-loop", str(loop_flag),
+        # ✅ 결과 GIF는 디스크에 쓰지 않고 stdout으로 바로 받기
+        "-f", "gif",
+        "pipe:1"
+    ]
+
+    return _run_ffmpeg(cmd_gif, video if piped else None, on_progress=on_progress)